@@ -15,6 +15,7 @@ DEFAULTS = {
 
     'INIT_SERIALIZER': 'chunked_upload.serializers.InitialUploadRequestSerializer',
     'UPLOAD_SERIALIZER': 'chunked_upload.serializers.UploadSerializer',
+    'BATCH_UPLOAD_SERIALIZER': 'chunked_upload.serializers.BatchUploadSerializer',
     'RESPONSE_SERIALIZER': 'chunked_upload.serializers.UploadResponseSerializer',
 }
 
@@ -36,12 +37,17 @@ class Settings:
     def __init__(self):
         # try to get `CHUNKED_UPLOAD` dictionary from django.conf.settings. if not, use defaults
         self._user_settings = getattr(dj_settings, 'CHUNKED_UPLOAD', DEFAULTS)
+        # resolved values of the settings, so callables and import strings are resolved only once
+        self._resolved = {}
 
     def __getattr__(self, name):
         if name not in DEFAULTS:
             msg = "'%s' object has no attribute '%s'"
             raise AttributeError(msg % (self.__class__.__name__, name))
 
+        if name in self._resolved:
+            return self._resolved[name]
+
         value = self.get_setting(name)
 
         if is_callable(value):
@@ -53,6 +59,7 @@ class Settings:
             except ImportError:
                 pass
 
+        self._resolved[name] = value
         return value
 
     def get_setting(self, setting):
@@ -63,6 +70,9 @@ class Settings:
         if setting not in DEFAULTS:
             return
 
+        # drop the resolved value, so the new one is resolved on the next access
+        self._resolved.pop(setting, None)
+
         # if exiting, delete value to repopulate
         if enter:
             self._user_settings[setting] = value
@@ -0,0 +1,12 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+__all__ = [
+    'UploadLocked',
+]
+
+
+class UploadLocked(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Another chunk of the file is being uploaded. Please retry later.'
+    default_code = 'upload_locked'
@@ -1,18 +1,31 @@
 import hashlib
+import mmap
 import os
+import sys
 import time
 import uuid
 
 from django.contrib.auth import get_user_model
-from django.contrib.postgres.indexes import HashIndex
-from django.core.files.storage import default_storage
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
 from django.db import models, transaction
 from django.utils import timezone
+from django.utils.functional import cached_property
 from rest_framework.exceptions import ValidationError
 
 from . import utils
 from .config import settings
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 HASH_FUNCTION_MAPPING = {
     'MD5': hashlib.md5,
     'SHA1': hashlib.sha1,
@@ -20,6 +33,19 @@ HASH_FUNCTION_MAPPING = {
     'SHA512': hashlib.sha512,
 }
 
+# faster hash functions, available if their packages are installed
+if blake3 is not None:
+    HASH_FUNCTION_MAPPING['BLAKE3'] = blake3.blake3
+
+if xxhash is not None:
+    HASH_FUNCTION_MAPPING['XXH3'] = xxhash.xxh3_128
+
+# size of the buffers read from an uploaded chunk while hashing and storing it
+STREAM_BUFFER_SIZE = 1 << 20  # 1 MB
+
+# only linux can `sendfile()` between two regular files
+SENDFILE_SUPPORTED = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+
 User = get_user_model()
 
 
@@ -51,17 +77,20 @@ def default_upload_to(instance, filename):
 
 
 class ChunkedFileUpload(models.Model):
-    class HashFunction(models.TextChoices):
-        MD5 = 'MD5'
-        SHA1 = 'SHA1'
-        SHA256 = 'SHA256'
-        SHA512 = 'SHA512'
-
-    class Status(models.TextChoices):
-        INITIAL = 'INITIAL'
-        UPLOADING = 'UPLOADING'
-        SUCCESSFUL = 'SUCCESSFUL'
-        FAILED = 'FAILED'
+    # the labels are the names used by the API and the settings, the values are what is stored in the database
+    class HashFunction(models.IntegerChoices):
+        MD5 = 0, 'MD5'
+        SHA1 = 1, 'SHA1'
+        SHA256 = 2, 'SHA256'
+        SHA512 = 3, 'SHA512'
+        BLAKE3 = 4, 'BLAKE3'
+        XXH3 = 5, 'XXH3'
+
+    class Status(models.IntegerChoices):
+        INITIAL = 0, 'INITIAL'
+        UPLOADING = 1, 'UPLOADING'
+        SUCCESSFUL = 2, 'SUCCESSFUL'
+        FAILED = 3, 'FAILED'
 
     unique_id = models.UUIDField(
         default=uuid.uuid4,
@@ -69,8 +98,7 @@ class ChunkedFileUpload(models.Model):
         unique=True,
         help_text='unique identifier for the file, to relate chunks to the file'
     )
-    status = models.CharField(
-        max_length=16,
+    status = models.PositiveSmallIntegerField(
         choices=Status.choices,
         default=Status.INITIAL,
         help_text='status of the file and uploading process'
@@ -92,7 +120,7 @@ class ChunkedFileUpload(models.Model):
     )
 
     original_file_name = models.CharField(
-        max_length=512,
+        max_length=255,
         help_text='original file name to rename it after a successful upload'
     )
 
@@ -121,8 +149,7 @@ class ChunkedFileUpload(models.Model):
         help_text='current size of the file on disk in bytes'
     )
 
-    hash_function = models.CharField(
-        max_length=8,
+    hash_function = models.PositiveSmallIntegerField(
         choices=HashFunction.choices,
         default=HashFunction.MD5,
         editable=False,
@@ -130,10 +157,10 @@ class ChunkedFileUpload(models.Model):
     )
 
     last_calculated_hash = models.CharField(
-        max_length=512,
+        max_length=128,
         null=True,
         blank=True,
-        help_text='iterative hash of the file. it store the hash of the each chunk, and the last calculated hash'
+        help_text='iterative hash of the file. it chains the hash of each chunk to the last calculated hash'
     )
 
     error_message = models.TextField(
@@ -165,46 +192,94 @@ class ChunkedFileUpload(models.Model):
     class Meta:
         abstract = True
         ordering = ['completed_at', '-updated_at']
-        indexes = [
-            models.Index(fields=['unique_id', 'status'], name='unique_id_status_idx'),
-            HashIndex(fields=['unique_id'], name='unique_id_hash_idx')
-        ]
+        # no extra indexes: `unique_id` is unique, so its own index already answers the lookups of an upload
 
     def reset_retry_threshold(self):
         self.retry_threshold = settings.RETRY_THRESHOLD
 
-    def calculate_hash(self, chunk, original_chunk_hash) -> [bool, str]:
-        hash_function = HASH_FUNCTION_MAPPING.get(self.hash_function)
-        chunk_hash = hash_function(chunk.read()).hexdigest()
-
-        if original_chunk_hash != chunk_hash:
-            return False, None, 'Sent chunk is corrupted. Please retry uploading the chunk.'
-
-        _hash = chunk_hash
-
-        if self.last_calculated_hash:
-            _hash = hash_function(
-                self.last_calculated_hash.encode() + chunk_hash.encode(),
-                usedforsecurity=False
-            ).hexdigest()
+    @cached_property
+    def _hash_constructor(self):
+        # an unknown hash function must fail loudly, instead of failing later on calling None
+        return HASH_FUNCTION_MAPPING[self.HashFunction(self.hash_function).label]
 
-        return True, _hash, None
-
-    def __append(self, chunk):
+    def create_file(self):
+        """
+        Create the empty file that the chunks are appended to
+        :return:
+        """
+        self.file.save(self.original_file_name, ContentFile(b''), save=False)
 
+    def _get_storage(self):
         # check if the storage is not set
         storage = self.file.storage
 
         if not storage:
             storage = default_storage
 
-        with storage.open(self.file.name, 'ab') as file:
-            file.write(chunk.read())
+        return storage
+
+    def _open_for_append(self, storage):
+        # local files are opened directly with a large write buffer, so the chunk is written in fewer system calls
+        if isinstance(storage, FileSystemStorage):
+            return open(storage.path(self.file.name), 'ab', buffering=STREAM_BUFFER_SIZE)
+
+        return storage.open(self.file.name, 'ab')
+
+    def _write_chunk(self, chunk, file, storage, hasher):
+        """
+        Write a chunk to the end of the file, and update the hasher with its content
+        :param chunk: the uploaded chunk
+        :param file: the file opened for appending
+        :param storage: storage of the file
+        :param hasher: hasher of the chunk
+        :return:
+        """
+        if SENDFILE_SUPPORTED and hasattr(chunk, 'temporary_file_path') and isinstance(storage, FileSystemStorage):
+            # write what's buffered from the previous chunks first, as the chunk is written through another descriptor
+            file.flush()
+
+            # both files are on the local disk, so the kernel copies the chunk and it's hashed from a memory map
+            with open(chunk.temporary_file_path(), 'rb') as src, \
+                    open(storage.path(self.file.name), 'r+b', buffering=0) as dest:
+                # `sendfile()` can't write to a file opened for appending, so the end of the file is sought instead
+                dest.seek(0, os.SEEK_END)
+
+                if chunk.size:
+                    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                        hasher.update(view)
+
+                offset = 0
+                while offset < chunk.size:
+                    sent = os.sendfile(dest.fileno(), src.fileno(), offset, chunk.size - offset)
+                    if not sent:
+                        # the chunk is hashed from the source, so a short copy must not pass as a stored chunk
+                        raise OSError('Short sendfile: %d of %d bytes are copied' % (offset, chunk.size))
+                    offset += sent
+
+            return
+
+        # hash and store the chunk in a single pass over its content
+        for buf in chunk.chunks(STREAM_BUFFER_SIZE):
+            hasher.update(buf)
+            file.write(buf)
+
+    def _chain_hash(self, last_hash, chunk_hash):
+        """
+        Chain the hash of a chunk to the hash of the previous chunks.
+        The chained hash is stored after every chunk, so it's resumed without reading the stored file again.
+        :param last_hash: hash of the previous chunks, or None for the first chunk
+        :param chunk_hash: hash of the chunk
+        :return: hex digest of the chain
+        """
+        if not last_hash:
+            return chunk_hash
+
+        return self._hash_constructor(last_hash.encode() + chunk_hash.encode()).hexdigest()
 
     def _raise_retry(self, error, user_message=None):
         if self.retry_threshold > 0:
             self.retry_threshold -= 1
-            self.save()
+            self.save(update_fields=['retry_threshold'])
 
             if user_message:
                 error = user_message
@@ -214,7 +289,7 @@ class ChunkedFileUpload(models.Model):
             self.status = self.Status.FAILED
             self.completed_at = timezone.now()
             self.error_message = error
-            self.save()
+            self.save(update_fields=['status', 'completed_at', 'error_message', 'updated_at'])
             self.delete_file()
             raise ValidationError({'message': user_message})
 
@@ -226,32 +301,80 @@ class ChunkedFileUpload(models.Model):
         :param chunk:
         :return:
         """
+        self.append_chunks([(chunk, original_chunk_hash)], final_hash=final_hash)
+
+    def append_chunks(self, chunks, final_hash: str = None):
+        """
+        Append several chunks to the file, and save the upload once at the end.
+        The chunks are all-or-nothing: if any of them is corrupted or can't be stored, none of them is kept.
+        :param chunks: (chunk, original_chunk_hash) pairs, in the order of the file
+        :param final_hash:
+        :return:
+        """
+        chunks = list(chunks)
 
-        if self.max_file_size is not None and self.current_file_size + len(chunk) > self.max_file_size:
+        # the file API knows the size of the chunk, unlike len(), which may have to read the chunk for some files
+        chunks_len = sum(chunk.size for chunk, _ in chunks)
+
+        if self.max_file_size is not None and self.current_file_size + chunks_len > self.max_file_size:
             self.status = self.Status.FAILED
             self.completed_at = timezone.now()
             self.error_message = 'File size exceeded the maximum allowed size'
-            self.save()
+            self.save(update_fields=['status', 'completed_at', 'error_message', 'updated_at'])
 
             raise ValidationError(self.error_message)
 
-        ok, _hash, error = self.calculate_hash(chunk, original_chunk_hash)
-
-        if not self.file:
-            self.file = chunk
-            if self.status == self.Status.INITIAL:
-                self.status = self.Status.UPLOADING
-        else:
-            if not ok:
-                self._raise_retry(error)
+        # only the changed columns are saved, once the chunks are stored
+        update_fields = ['offset', 'current_file_size', 'last_calculated_hash', 'retry_threshold', 'updated_at']
 
-            try:
-                self.__append(chunk)
-            except Exception as e:  # noqa
-                self._raise_retry(str(e), user_message='Failed to store the chunk. Please retry uploading the chunk.')
-            self.reset_retry_threshold()
+        # resolved before storing the chunks, so an unknown hash function is not reported as a storage failure
+        hash_constructor = self._hash_constructor
 
-        self.offset += len(chunk)
+        if not self.file:
+            # uploads that were initialized before the file was created on the initial request
+            self.create_file()
+            update_fields.append('file')
+
+        try:
+            storage = self._get_storage()
+            prev_size = storage.size(self.file.name)
+            corrupted = False
+            _hash = self.last_calculated_hash
+
+            with self._open_for_append(storage) as file:
+                try:
+                    for chunk, original_chunk_hash in chunks:
+                        hasher = hash_constructor()
+                        self._write_chunk(chunk, file, storage, hasher)
+                        chunk_hash = hasher.hexdigest()
+
+                        if chunk_hash != original_chunk_hash:
+                            corrupted = True
+                            break
+
+                        # the chain is extended only by the chunks that are not corrupted
+                        _hash = self._chain_hash(_hash, chunk_hash)
+                except Exception:
+                    # drop whatever is written of the chunks of this call, before the failure is reported
+                    file.truncate(prev_size)
+                    raise
+
+                if corrupted:
+                    # drop the chunks of this call from the end of the file
+                    file.truncate(prev_size)
+        except Exception as e:  # noqa
+            self._raise_retry(str(e), user_message='Failed to store the chunk. Please retry uploading the chunk.')
+
+        if corrupted:
+            self._raise_retry('Sent chunk is corrupted. Please retry uploading the chunk.')
+
+        self.reset_retry_threshold()
+
+        if self.status == self.Status.INITIAL:
+            self.status = self.Status.UPLOADING
+            update_fields.append('status')
+
+        self.offset += chunks_len
         self.current_file_size = self.offset
         self.last_calculated_hash = _hash
 
@@ -263,16 +386,22 @@ class ChunkedFileUpload(models.Model):
                 self.status = self.Status.FAILED
 
             self.completed_at = timezone.now()
+            update_fields.extend(['status', 'completed_at'])
 
         elif self.current_file_size > self.original_file_size:
             self.error_message = 'File size exceeded the original file size'
             self.status = self.Status.FAILED
             self.completed_at = timezone.now()
+            update_fields.extend(['status', 'completed_at'])
+
+        # error message is deferred by the upload serializer, so it's only touched when the upload has failed
+        if self.status == self.Status.FAILED:
+            update_fields.append('error_message')
 
         self.file.close()
-        self.save()
+        self.save(update_fields=update_fields)
 
-        if self.error_message or self.status == self.Status.FAILED:
+        if self.status == self.Status.FAILED:
             self.delete_file()
             raise ValidationError({'message': self.error_message})
 
@@ -280,13 +409,12 @@ class ChunkedFileUpload(models.Model):
 
         if not settings.PRESERVE_FAILED_UPLOAD_FILE:
             if self.file:
-                storage, path = self.file.storage, self.file.path
-
-                if not storage:
-                    storage = default_storage
-
-                if storage.exists(path):
-                    storage.delete(path)
+                # `name` works on every storage, unlike `path`. and deleting a missing file is a no-op on most of the
+                # storages, so there's no need for an extra `exists()` call (an extra request on cloud storages)
+                try:
+                    self._get_storage().delete(self.file.name)
+                except FileNotFoundError:
+                    pass
 
             self.file = None
 
@@ -306,7 +434,7 @@ class ChunkedFileUpload(models.Model):
 
     def __str__(self):
         return u'<%s - upload_id: %s - size: %s - status: %s>' % (
-            self.original_file_name, self.unique_id, self.hr_current_file_size, self.status)
+            self.original_file_name, self.unique_id, self.hr_current_file_size, self.get_status_display())
 
     def __repr__(self):
         return self.__str__()
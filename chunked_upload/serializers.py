@@ -1,10 +1,12 @@
-from django.core.files.base import ContentFile
 from rest_framework import serializers
 
 from .config import settings
+from .exceptions import UploadLocked
+from .models import HASH_FUNCTION_MAPPING
 from . import utils
 
 __all__ = [
+    'BatchUploadSerializer',
     'InitialUploadRequestSerializer',
     'UploadResponseSerializer',
     'UploadSerializer',
@@ -23,7 +25,7 @@ class InitialUploadRequestSerializer(serializers.Serializer):
 
     # these fields are required if unique_id is not provided (new upload request)
     file_size = serializers.IntegerField(min_value=0, required=False, source='original_file_size')
-    file_name = serializers.CharField(max_length=512, required=False, source='original_file_name')
+    file_name = serializers.CharField(max_length=255, required=False, source='original_file_name')
 
     # these fields are required if unique_id is provided (resume upload request). the hash function that was used
     # to calculate the hash of the file on the client side. it will be used to check if the file is corrupted or not.
@@ -57,9 +59,15 @@ class InitialUploadRequestSerializer(serializers.Serializer):
         return value
 
     def validate_hash_function(self, value):
-        if value not in self.model.HashFunction.values:
+        if value not in self.model.HashFunction.labels:
             raise serializers.ValidationError('Invalid hash function')
-        return value
+
+        # optional hash functions are available only if their packages are installed
+        if value not in HASH_FUNCTION_MAPPING:
+            raise serializers.ValidationError('Hash function is not available')
+
+        # hash functions are stored by their values
+        return self.model.HashFunction[value]
 
     def validate(self, attrs):
         attrs = super().validate(attrs)
@@ -102,6 +110,8 @@ class InitialUploadRequestSerializer(serializers.Serializer):
             if user and user.is_authenticated:
                 file_model.user = user
 
+            # create the empty file up front, so every chunk is appended to it in the same way
+            file_model.create_file()
             file_model.save()
 
         else:
@@ -115,6 +125,9 @@ class InitialUploadRequestSerializer(serializers.Serializer):
 
 
 class UploadResponseSerializer(serializers.ModelSerializer):
+    # status is stored as an integer, but it is shown by its name
+    status = serializers.CharField(source='get_status_display', read_only=True)
+
     class Meta:
         fields = [
             'unique_id',
@@ -140,8 +153,26 @@ class UploadResponseSerializer(serializers.ModelSerializer):
 class UploadSerializer(serializers.Serializer):
     unique_id = serializers.UUIDField()
     offset = serializers.IntegerField(min_value=0)
-    chunk_hash = serializers.CharField(max_length=256, required=True, allow_null=False, allow_blank=False)
-    final_hash = serializers.CharField(max_length=256, required=False, allow_null=True, allow_blank=True)
+    chunk_hash = serializers.CharField(max_length=128, required=True, allow_null=False, allow_blank=False)
+    final_hash = serializers.CharField(max_length=128, required=False, allow_null=True, allow_blank=True)
+
+    # the columns of the upload that are needed to append a chunk and to build the response
+    model_fields = [
+        'id',
+        'unique_id',
+        'user',
+        'status',
+        'file',
+        'original_file_name',
+        'max_file_size',
+        'chunk_size',
+        'offset',
+        'original_file_size',
+        'current_file_size',
+        'hash_function',
+        'last_calculated_hash',
+        'retry_threshold',
+    ]
 
     class Meta:
         fields = [
@@ -156,12 +187,17 @@ class UploadSerializer(serializers.Serializer):
     def validate(self, attrs):
         attrs = super().validate(attrs)
 
+        queryset = self.model.objects.filter(unique_id=attrs['unique_id'], status__in=[
+            self.model.Status.UPLOADING,
+            self.model.Status.INITIAL
+        ])
+
+        # lock the upload until the chunk is stored, so concurrent requests can't append to the file at the same time
         try:
-            file_model = self.model.objects.get(unique_id=attrs['unique_id'], status__in=[
-                self.model.Status.UPLOADING,
-                self.model.Status.INITIAL
-            ])
+            file_model = queryset.select_for_update(skip_locked=True).only(*self.model_fields).get()
         except self.model.DoesNotExist:
+            if queryset.exists():
+                raise UploadLocked()
             raise serializers.ValidationError('File does not exist or not in a valid state')
 
         if file_model.offset != attrs['offset']:
@@ -180,10 +216,46 @@ class UploadSerializer(serializers.Serializer):
 
         file_model = validated_data['file_model']
 
+        if file.size > file_model.chunk_size:
+            raise serializers.ValidationError('Chunk size is greater than the allowed chunk size')
+
+        # the uploaded file is passed as is, so the chunk is streamed instead of being read into the memory
         file_model.append_chunk(
-            chunk=ContentFile(file.read(file_model.chunk_size), name=file_model.original_file_name),
+            chunk=file,
             original_chunk_hash=validated_data['chunk_hash'],
             final_hash=validated_data.get('final_hash'),
         )
 
         return file_model
+
+
+class BatchUploadSerializer(UploadSerializer):
+    # the chunks are sent as several `file` parts, and their hashes in the same order
+    chunk_hash = None
+    chunk_hashes = serializers.ListField(
+        child=serializers.CharField(max_length=128, allow_blank=False),
+        allow_empty=False,
+    )
+
+    def create(self, validated_data):
+
+        files = self.context['request'].FILES.getlist('file')
+
+        if not files:
+            raise serializers.ValidationError('File is required')
+
+        if len(files) != len(validated_data['chunk_hashes']):
+            raise serializers.ValidationError('Number of the chunks and their hashes does not match')
+
+        file_model = validated_data['file_model']
+
+        if any(file.size > file_model.chunk_size for file in files):
+            raise serializers.ValidationError('Chunk size is greater than the allowed chunk size')
+
+        # all the chunks are stored under the same lock, and the upload is saved once
+        file_model.append_chunks(
+            chunks=zip(files, validated_data['chunk_hashes']),
+            final_hash=validated_data.get('final_hash'),
+        )
+
+        return file_model
@@ -0,0 +1,374 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .models import HASH_FUNCTION_MAPPING, SENDFILE_SUPPORTED, ChunkedFileUpload
+from .utils import human_readable_size
+from .views import BatchUploadAPIView, InitialUploadAPIView, UploadAPIView
+
+
+class Upload(ChunkedFileUpload):
+    class Meta(ChunkedFileUpload.Meta):
+        app_label = 'chunked_upload'
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def final_hash(parts, hash_function=hashlib.md5):
+    # the hash of each chunk, chained to the hash of the previous chunks
+    _hash = hash_function(parts[0]).hexdigest()
+    for part in parts[1:]:
+        _hash = hash_function((_hash + hash_function(part).hexdigest()).encode()).hexdigest()
+    return _hash
+
+
+class ChunkedUploadTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # the model is only defined for the tests, so it has no migration
+        with connection.schema_editor() as editor:
+            editor.create_model(Upload)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(Upload)
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = get_user_model().objects.create(username='user')
+
+        self.parts = [os.urandom(1000), os.urandom(1000), os.urandom(500)]
+        self.data = b''.join(self.parts)
+
+        self.upload = Upload(original_file_name='file.bin', original_file_size=len(self.data))
+        self.upload.create_file()
+        self.upload.save()
+
+    def post_init(self, **data):
+        request = APIRequestFactory().post('/', {
+            'file_name': 'file.bin',
+            'file_size': len(self.data),
+            **data,
+        }, format='multipart')
+        force_authenticate(request, user=self.user)
+
+        return InitialUploadAPIView.as_view(model=Upload)(request)
+
+    def post_chunk(self, part, **data):
+        request = APIRequestFactory().post('/', {
+            'unique_id': self.upload.unique_id,
+            'offset': self.upload.offset,
+            'chunk_hash': md5(part),
+            'file': SimpleUploadedFile('chunk', part),
+            **data,
+        }, format='multipart')
+        force_authenticate(request, user=self.user)
+
+        return UploadAPIView.as_view(model=Upload)(request)
+
+    def post_batch(self, parts, hashes=None, **data):
+        # the chunks are repeated `file` parts, with their hashes in the same order
+        request = APIRequestFactory().post('/', {
+            'unique_id': self.upload.unique_id,
+            'offset': self.upload.offset,
+            'chunk_hashes': hashes or [md5(part) for part in parts],
+            'file': [SimpleUploadedFile('chunk', part) for part in parts],
+            **data,
+        }, format='multipart')
+        force_authenticate(request, user=self.user)
+
+        return BatchUploadAPIView.as_view(model=Upload)(request)
+
+    def chunks(self, parts, hashes=None):
+        hashes = hashes or [md5(part) for part in parts]
+        return [(SimpleUploadedFile('chunk', part), chunk_hash) for part, chunk_hash in zip(parts, hashes)]
+
+    def temporary_file(self, part):
+        # a chunk bigger than FILE_UPLOAD_MAX_MEMORY_SIZE is received as a temporary file like this one
+        file = TemporaryUploadedFile('chunk', 'application/octet-stream', len(part), None)
+        self.addCleanup(file.close)
+        file.write(part)
+        file.seek(0)
+        return file
+
+    def stored_size(self):
+        return os.path.getsize(self.upload.file.path)
+
+
+class UploadTestCase(ChunkedUploadTestCase):
+
+    def test_append_chunks(self):
+        self.upload.append_chunks(self.chunks(self.parts[:2]))
+        self.assertEqual(self.upload.last_calculated_hash, final_hash(self.parts[:2]))
+
+        self.upload.append_chunks(self.chunks(self.parts[2:]), final_hash=final_hash(self.parts))
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.status, Upload.Status.SUCCESSFUL)
+        self.assertEqual(self.upload.offset, len(self.data))
+        with open(self.upload.file.path, 'rb') as file:
+            self.assertEqual(file.read(), self.data)
+
+    def test_corrupted_chunk_drops_the_batch(self):
+        self.upload.append_chunks(self.chunks(self.parts[:1]))
+
+        with self.assertRaises(ValidationError):
+            self.upload.append_chunks(self.chunks(self.parts[1:], hashes=[md5(self.parts[1]), 'corrupted']))
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.stored_size(), 1000)
+        self.assertEqual(self.upload.offset, 1000)
+        self.assertEqual(self.upload.retry_threshold, 1)
+
+        # retrying the whole batch completes the upload
+        self.upload.append_chunks(self.chunks(self.parts[1:]), final_hash=final_hash(self.parts))
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.status, Upload.Status.SUCCESSFUL)
+
+    def test_failed_write_drops_the_batch(self):
+        write_chunk = Upload._write_chunk
+        calls = []
+
+        def failing_write_chunk(upload, chunk, file, storage, hasher):
+            calls.append(chunk)
+            if len(calls) == 2:
+                # a part of the chunk gets written before the failure
+                file.write(b'partial')
+                raise OSError('No space left on device')
+            return write_chunk(upload, chunk, file, storage, hasher)
+
+        with mock.patch.object(Upload, '_write_chunk', failing_write_chunk):
+            with self.assertRaises(ValidationError):
+                self.upload.append_chunks(self.chunks(self.parts[:2]))
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.stored_size(), 0)
+        self.assertEqual(self.upload.offset, 0)
+        self.assertEqual(self.upload.retry_threshold, 1)
+
+        # retrying the whole batch completes the upload
+        self.upload.append_chunks(self.chunks(self.parts), final_hash=final_hash(self.parts))
+        self.upload.refresh_from_db()
+        self.assertEqual(self.stored_size(), len(self.data))
+        self.assertEqual(self.upload.status, Upload.Status.SUCCESSFUL)
+
+    def test_unknown_hash_function_is_not_retried(self):
+        self.upload.hash_function = 99
+
+        with self.assertRaises(ValueError):
+            self.upload.append_chunks(self.chunks(self.parts[:1]))
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.stored_size(), 0)
+        self.assertEqual(self.upload.retry_threshold, 2)
+        self.assertEqual(self.upload.status, Upload.Status.INITIAL)
+
+    def test_locked_upload(self):
+        def skip_locked_row(queryset, **kwargs):
+            # sqlite has no row locks, so the row is skipped as if another request has locked it
+            return queryset.none()
+
+        with mock.patch.object(QuerySet, 'select_for_update', skip_locked_row):
+            response = self.post_chunk(self.parts[0])
+
+        self.assertEqual(response.status_code, 409)
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.offset, 0)
+        self.assertEqual(self.stored_size(), 0)
+
+    def test_rejected_chunk_keeps_the_retry(self):
+        response = self.post_chunk(self.parts[0], chunk_hash='corrupted')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['left_retries'], '1')
+
+        # the decremented retry counter is committed with the view's transaction, although the chunk is rejected
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.retry_threshold, 1)
+        self.assertEqual(self.upload.offset, 0)
+
+    def test_upload_does_not_load_deferred_fields(self):
+        for i, part in enumerate(self.parts):
+            data = {'final_hash': final_hash(self.parts)} if i == len(self.parts) - 1 else {}
+
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post_chunk(part, **data)
+
+            self.upload.refresh_from_db()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['last_calculated_hash'], final_hash(self.parts[:i + 1]))
+            for query in queries.captured_queries:
+                self.assertNotIn('error_message', query['sql'])
+
+        self.assertEqual(self.upload.status, Upload.Status.SUCCESSFUL)
+
+
+@skipUnless(SENDFILE_SUPPORTED, 'sendfile() between regular files is only supported on linux')
+class SendfileTestCase(ChunkedUploadTestCase):
+
+    def test_append_chunks(self):
+        with mock.patch.object(os, 'sendfile', wraps=os.sendfile) as sendfile:
+            self.upload.append_chunks(
+                [(self.temporary_file(part), md5(part)) for part in self.parts], final_hash=final_hash(self.parts)
+            )
+
+        self.assertTrue(sendfile.called)
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.status, Upload.Status.SUCCESSFUL)
+        with open(self.upload.file.path, 'rb') as file:
+            self.assertEqual(file.read(), self.data)
+
+    def test_corrupted_chunk_drops_the_batch(self):
+        self.upload.append_chunks([(self.temporary_file(self.parts[0]), md5(self.parts[0]))])
+
+        with self.assertRaises(ValidationError):
+            self.upload.append_chunks([(self.temporary_file(self.parts[1]), 'corrupted')])
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.stored_size(), 1000)
+        self.assertEqual(self.upload.offset, 1000)
+        self.assertEqual(self.upload.retry_threshold, 1)
+
+    def test_mixed_batch(self):
+        # the in-memory chunk is written through the buffered file, between the two copied by sendfile()
+        chunks = [
+            (self.temporary_file(self.parts[0]), md5(self.parts[0])),
+            (SimpleUploadedFile('chunk', self.parts[1]), md5(self.parts[1])),
+            (self.temporary_file(self.parts[2]), md5(self.parts[2])),
+        ]
+        self.upload.append_chunks(chunks, final_hash=final_hash(self.parts))
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.status, Upload.Status.SUCCESSFUL)
+        with open(self.upload.file.path, 'rb') as file:
+            self.assertEqual(file.read(), self.data)
+
+    def test_short_copy_drops_the_batch(self):
+        self.upload.append_chunks([(self.temporary_file(self.parts[0]), md5(self.parts[0]))])
+
+        # the chunk is hashed from the source, so only the copy falls short
+        with mock.patch.object(os, 'sendfile', return_value=0):
+            with self.assertRaises(ValidationError):
+                self.upload.append_chunks([(self.temporary_file(self.parts[1]), md5(self.parts[1]))])
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.stored_size(), 1000)
+        self.assertEqual(self.upload.offset, 1000)
+        self.assertEqual(self.upload.retry_threshold, 1)
+
+
+class HumanReadableSizeTestCase(SimpleTestCase):
+
+    def test_human_readable_size(self):
+        for size, expected in [
+            (0, '0.00 B'),
+            (1023, '1023.00 B'),
+            (1024, '1.00 KB'),
+            (1536, '1.50 KB'),
+            (64 * 10 ** 6, '61.04 MB'),
+            (5e9, '4.66 GB'),
+            (1 << 90, '1024.00 YB'),
+        ]:
+            with self.subTest(size=size):
+                self.assertEqual(human_readable_size(size), expected)
+
+
+class HashFunctionTestCase(ChunkedUploadTestCase):
+
+    def test_hash_function_is_not_available(self):
+        available = {name: constructor for name, constructor in HASH_FUNCTION_MAPPING.items() if name != 'XXH3'}
+
+        with mock.patch.dict(HASH_FUNCTION_MAPPING, available, clear=True):
+            response = self.post_init(hash_function='XXH3')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['hash_function'], ['Hash function is not available'])
+
+    def assert_chained_upload(self, name):
+        hash_function = HASH_FUNCTION_MAPPING[name]
+
+        response = self.post_init(hash_function=name)
+        self.assertEqual(response.status_code, 200)
+        self.upload = Upload.objects.get(unique_id=response.data['unique_id'])
+        self.assertEqual(self.upload.hash_function, Upload.HashFunction[name])
+
+        for i, part in enumerate(self.parts):
+            data = {'final_hash': final_hash(self.parts, hash_function)} if i == len(self.parts) - 1 else {}
+            response = self.post_chunk(part, chunk_hash=hash_function(part).hexdigest(), **data)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['last_calculated_hash'], final_hash(self.parts[:i + 1], hash_function))
+            self.upload.refresh_from_db()
+
+        self.assertEqual(self.upload.status, Upload.Status.SUCCESSFUL)
+
+    @skipUnless('BLAKE3' in HASH_FUNCTION_MAPPING, 'the blake3 package is not installed')
+    def test_blake3_upload(self):
+        self.assert_chained_upload('BLAKE3')
+
+    @skipUnless('XXH3' in HASH_FUNCTION_MAPPING, 'the xxhash package is not installed')
+    def test_xxh3_upload(self):
+        self.assert_chained_upload('XXH3')
+
+
+class BatchUploadAPITestCase(ChunkedUploadTestCase):
+
+    def test_batch_upload(self):
+        # no `chunk_hash` is sent, the batch only needs `chunk_hashes`
+        response = self.post_batch(self.parts[:2])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['offset'], 2000)
+        self.assertEqual(response.data['last_calculated_hash'], final_hash(self.parts[:2]))
+
+        self.upload.refresh_from_db()
+        response = self.post_batch(self.parts[2:], final_hash=final_hash(self.parts))
+        self.assertEqual(response.status_code, 200)
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.status, Upload.Status.SUCCESSFUL)
+        with open(self.upload.file.path, 'rb') as file:
+            self.assertEqual(file.read(), self.data)
+
+    def test_hashes_do_not_match_the_chunks(self):
+        response = self.post_batch(self.parts[:2], hashes=[md5(self.parts[0])])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, ['Number of the chunks and their hashes does not match'])
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.offset, 0)
+        self.assertEqual(self.stored_size(), 0)
+
+    def test_chunk_is_too_big(self):
+        self.upload.chunk_size = 600
+        self.upload.save()
+
+        # only the second chunk is bigger than the chunk size
+        response = self.post_batch([self.parts[2], self.parts[0]])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, ['Chunk size is greater than the allowed chunk size'])
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.offset, 0)
+        self.assertEqual(self.stored_size(), 0)
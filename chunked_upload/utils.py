@@ -1,8 +1,12 @@
 import os
-import re
+import string
 import unicodedata
 
-_filename_ascii_strip_re = re.compile(r"[^A-Za-z0-9_.-]")
+# translation tables used by `secure_filename`, built once instead of on every call
+_filename_sep_table = str.maketrans({sep: " " for sep in (os.sep, os.path.altsep) if sep})
+_filename_ascii_strip_table = str.maketrans(
+    "", "", "".join(c for c in map(chr, range(128)) if c not in string.ascii_letters + string.digits + "_.-")
+)
 _windows_device_files = {
     "CON",
     "PRN",
@@ -12,6 +16,8 @@ _windows_device_files = {
     *(f"LPT{i}" for i in range(10)),
 }
 
+_size_units = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+
 
 # This function is copied from werkzeug.utils.secure_filename:
 # https://github.com/pallets/werkzeug/blob/2bcb43c3574de33b36174c6dc964182ccbc14a69/src/werkzeug/utils.py#L195
@@ -42,12 +48,8 @@ def secure_filename(filename: str) -> str:
     filename = unicodedata.normalize("NFKD", filename)
     filename = filename.encode("ascii", "ignore").decode("ascii")
 
-    for sep in os.sep, os.path.altsep:
-        if sep:
-            filename = filename.replace(sep, " ")
-    filename = str(_filename_ascii_strip_re.sub("", "_".join(filename.split()))).strip(
-        "._"
-    )
+    filename = "_".join(filename.translate(_filename_sep_table).split())
+    filename = filename.translate(_filename_ascii_strip_table).strip("._")
 
     # On nt a couple of special files are present in each folder.
     # We have to ensure that the target file is not such a filename.
@@ -68,8 +70,7 @@ def human_readable_size(size: int) -> str:
     :param size: int - file size in bytes
     :return: str - human-readable file size
     """
-    for unit in ["B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB"]:
-        if size < 1024:
-            return f"{size:.2f} {unit}"
-        size /= 1024
-    return f"{size:.2f} YB"
+    # every unit is 2 ** 10 times the previous one, so the unit is found from the bit length of the size.
+    # sizes may also be floats, e.g. `MAX_FILE_SIZE = 5e9` in the settings, and floats have no bit length
+    unit_index = min(len(_size_units) - 1, max(0, (int(size).bit_length() - 1) // 10))
+    return f"{size / (1 << (unit_index * 10)):.2f} {_size_units[unit_index]}"
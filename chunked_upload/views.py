@@ -1,3 +1,8 @@
+import functools
+
+from django.core.signals import setting_changed
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -6,11 +11,13 @@ from . import serializers
 from .config import settings
 
 __all__ = [
+    'BatchUploadAPIView',
     'InitialUploadAPIView',
     'UploadAPIView',
 ]
 
 
+@functools.lru_cache(maxsize=None)
 def get_upload_response_serializer():
     if serializer_class := settings.RESPONSE_SERIALIZER:
         return serializer_class
@@ -22,6 +29,7 @@ class InitialUploadAPIView(APIView):
     model = None
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_serializer_class():
         if serializer_class := settings.INIT_SERIALIZER:
             return serializer_class
@@ -45,19 +53,53 @@ class UploadAPIView(APIView):
     model = None
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_serializer_class():
         if serializer_class := settings.UPLOAD_SERIALIZER:
             return serializer_class
         return serializers.UploadSerializer
 
     def post(self, request, *args, **kwargs):
-        serializer = UploadAPIView.get_serializer_class()(
-            model=self.model,
-            data=request.data,
-            context={'request': request}
-        )
-        serializer.is_valid(raise_exception=True)
-        file_model = serializer.save()
+        # the upload is locked by the serializer's validation, until the chunk is stored
+        with transaction.atomic():
+            serializer = self.get_serializer_class()(
+                model=self.model,
+                data=request.data,
+                context={'request': request}
+            )
+            serializer.is_valid(raise_exception=True)
+
+            try:
+                file_model = serializer.save()
+                error = None
+            except ValidationError as e:
+                # a rejected chunk still changes the upload (e.g. the left retries), so the transaction is committed
+                error = e
+
+        if error is not None:
+            raise error
 
         serializer = get_upload_response_serializer()(file_model, model=self.model)
         return Response(serializer.data)
+
+
+class BatchUploadAPIView(UploadAPIView):
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_serializer_class():
+        if serializer_class := settings.BATCH_UPLOAD_SERIALIZER:
+            return serializer_class
+        return serializers.BatchUploadSerializer
+
+
+def clear_serializer_cache(setting, **kwargs):
+    # the serializer classes are resolved once, so they must be resolved again if their settings are overridden
+    if setting in ('INIT_SERIALIZER', 'UPLOAD_SERIALIZER', 'BATCH_UPLOAD_SERIALIZER', 'RESPONSE_SERIALIZER'):
+        get_upload_response_serializer.cache_clear()
+        InitialUploadAPIView.get_serializer_class.cache_clear()
+        UploadAPIView.get_serializer_class.cache_clear()
+        BatchUploadAPIView.get_serializer_class.cache_clear()
+
+
+setting_changed.connect(clear_serializer_cache)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# runs the tests of the app, with the minimal django settings they need
+import sys
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+
+
+def boot_django():
+    settings.configure(
+        DEBUG=True,
+        DATABASES={
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+            }
+        },
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'rest_framework',
+            "chunked_upload",
+        ),
+        TIME_ZONE="UTC",
+        USE_TZ=True,
+    )
+    django.setup()
+
+
+boot_django()
+
+call_command("test", "chunked_upload", *sys.argv[1:])
@@ -25,6 +25,10 @@ setup(
     install_requires=[
         'djangorestframework==3.14.0',
     ],
+    extras_require={
+        'blake3': ['blake3'],
+        'xxhash': ['xxhash'],
+    },
     author='Alireza Azadi',
     author_email='Alireza_Azadi@Hotmail.com',
     url='https://github.com/alirezaazadi/django-chunked-upload',